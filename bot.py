@@ -1,18 +1,41 @@
 import asyncio
 import logging
 import io
+import base64
+import math
+import time
 import requests
 import random
+import itertools
+import heapq
+import json
+import re
+import zlib
+import contextlib
+from collections import OrderedDict
 from datetime import datetime
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter
 import aiogram.types as types
 from aiogram.types import LabeledPrice, PreCheckoutQuery, SuccessfulPayment, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton
 from dotenv import load_dotenv
 import os
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
 import aiosqlite
 
+# Pillow опционален: без него фото отправляется как есть, без пережатия
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# NumPy опционален: без него поиск по старой истории отключён
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 logging.basicConfig(level=logging.INFO)
 
 load_dotenv()
@@ -20,6 +43,90 @@ API_TOKEN = os.getenv('TELEGRAM_TOKEN')
 client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 PAYMENT_TOKEN = os.getenv('PAYMENT_TOKEN', '')
 
+# Настройки анализа фото
+VISION_DETAIL = os.getenv('VISION_DETAIL', 'low')  # low / high / auto
+VISION_TARGET_SIDE = int(os.getenv('VISION_TARGET_SIDE', '768'))  # нужная длинная сторона, px
+VISION_JPEG_QUALITY = int(os.getenv('VISION_JPEG_QUALITY', '85'))
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', '1.0'))  # сколько ждать остальные фото альбома, сек
+MEDIA_GROUP_MAX_IMAGES = int(os.getenv('MEDIA_GROUP_MAX_IMAGES', '10'))
+MEDIA_GROUP_QUOTA = os.getenv('MEDIA_GROUP_QUOTA', 'album')  # album — одно использование на альбом, image — на каждое фото
+
+# Склейка сообщений (включается пользователем командой /merge)
+DEBOUNCE_WINDOW = float(os.getenv('DEBOUNCE_WINDOW', '2.0'))  # пауза, после которой пачка уходит в AI, сек
+DEBOUNCE_MAX_WAIT = float(os.getenv('DEBOUNCE_MAX_WAIT', '6.0'))  # максимум ожидания от первого сообщения, сек
+DEBOUNCE_MAX_MESSAGES = int(os.getenv('DEBOUNCE_MAX_MESSAGES', '10'))  # сообщений в одной пачке, дальше — новая пачка и новый запрос
+DEBOUNCE_MAX_CHARS = int(os.getenv('DEBOUNCE_MAX_CHARS', '4000'))  # символов в одной пачке
+
+# Лимиты Telegram на исходящие сообщения
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))  # сообщений в секунду на бота
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))  # сообщений в секунду на чат
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '4'))
+OUTBOUND_FLOOD_WINDOW = 5  # сек: окно, в котором считаются чаты, получившие TelegramRetryAfter
+OUTBOUND_GLOBAL_FLOOD_CHATS = 3  # столько чатов с флудом за окно — ставим на паузу весь бот
+MESSAGE_LIMIT = 4096
+
+# Подписки и бесплатные лимиты
+PLAN_DAYS = {'standard_200rub': 30, 'premium_500rub': 90}  # payload инвойса -> срок подписки в днях
+QUOTA_RESET_DAYS = int(os.getenv('QUOTA_RESET_DAYS', '30'))  # период пополнения бесплатных лимитов
+SUBSCRIPTION_SWEEP_INTERVAL = int(os.getenv('SUBSCRIPTION_SWEEP_INTERVAL', '60'))  # сек
+
+# Учёт токенов и стоимости
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()}
+USAGE_FLUSH_INTERVAL = int(os.getenv('USAGE_FLUSH_INTERVAL', '60'))  # сек
+MODEL_PRICES = {  # $ за 1M токенов: вход, кэшированный вход, выход
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+}
+
+# Маршрутизация по моделям: режим -> тариф -> параметры (переопределяется JSON в MODEL_ROUTES)
+MODEL_ROUTES = {
+    'text': {
+        'free': {'model': 'gpt-4o-mini', 'fallback': 'gpt-4.1-mini', 'max_tokens': 800, 'short_max_tokens': 300, 'temperature': 0.7},
+        'premium': {'model': 'gpt-4o-mini', 'fallback': 'gpt-4.1-mini', 'max_tokens': 1500, 'short_max_tokens': 400, 'temperature': 0.7},
+    },
+    'code': {
+        'free': {'model': 'gpt-4o-mini', 'fallback': 'gpt-4.1-mini', 'max_tokens': 1500, 'temperature': 0.2},
+        'premium': {'model': 'gpt-4o-mini', 'large_model': 'gpt-4o', 'fallback': 'gpt-4.1-mini', 'max_tokens': 3000, 'temperature': 0.2},
+    },
+    'vision': {
+        'free': {'model': 'gpt-4o-mini', 'fallback': 'gpt-4.1-mini', 'max_tokens': 600, 'temperature': 0.5},
+        'premium': {'model': 'gpt-4o-mini', 'fallback': 'gpt-4.1-mini', 'max_tokens': 1000, 'temperature': 0.5},
+    },
+}
+MODEL_ROUTES.update(json.loads(os.getenv('MODEL_ROUTES', '{}')))
+# Реплики только из этих слов («Привет!», «Спасибо большое») получают short_max_tokens, если он задан
+SMALL_TALK_WORDS = {'привет', 'приветик', 'здравствуй', 'здравствуйте', 'добрый', 'доброе', 'день', 'утро', 'вечер', 'спасибо', 'благодарю',
+                    'большое', 'ок', 'окей', 'хорошо', 'понятно', 'ясно', 'пока', 'hi', 'hello', 'hey', 'thanks', 'thank', 'you', 'ok', 'bye'}
+LARGE_PROMPT_CHARS = int(os.getenv('LARGE_PROMPT_CHARS', '3000'))  # большие запросы уходят на large_model, если он задан
+# Задержка зависит от длины ответа, поэтому здоровье меряем в секундах на токен ответа (10 ток/с — уже деградация)
+MODEL_TOKEN_LATENCY_SLO = float(os.getenv('MODEL_TOKEN_LATENCY_SLO', '0.1'))  # средняя задержка на токен, после которой модель считается нездоровой, сек
+MODEL_MIN_TOKENS = 100  # короткие ответы считаем как 100 токенов, чтобы время до первого токена не раздувало оценку
+MODEL_MAX_FAILURES = int(os.getenv('MODEL_MAX_FAILURES', '3'))  # ошибок подряд до переключения на запасную модель
+MODEL_COOLDOWN = int(os.getenv('MODEL_COOLDOWN', '60'))  # сколько держать модель выключенной, сек
+
+# Поиск релевантных старых сообщений (за пределами последних 5/10)
+RETRIEVAL_ENABLED = os.getenv('RETRIEVAL_ENABLED', '0') == '1' and np is not None
+RETRIEVAL_DIM = int(os.getenv('RETRIEVAL_DIM', '512'))  # размер хэш-вектора
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '4'))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv('RETRIEVAL_TOKEN_BUDGET', '600'))  # токенов на найденные фрагменты
+RETRIEVAL_MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE', '0.15'))
+RETRIEVAL_MAX_USERS = int(os.getenv('RETRIEVAL_MAX_USERS', '1000'))  # сколько индексов держать в памяти
+RETRIEVAL_MAX_ROWS = int(os.getenv('RETRIEVAL_MAX_ROWS', '100000'))  # строк векторов во всех индексах вместе (~200 МБ при DIM=512)
+
+# Ограничение частоты запросов: тариф -> режим -> [запас подряд, запросов в минуту] (переопределяется JSON в RATE_LIMITS)
+RATE_LIMITS = {
+    'free': {'text': [5, 10], 'code': [3, 3], 'image': [2, 2], 'vision': [2, 3]},
+    'premium': {'text': [10, 30], 'code': [6, 12], 'image': [4, 6], 'vision': [10, 12]},
+}
+RATE_LIMITS.update(json.loads(os.getenv('RATE_LIMITS', '{}')))
+RATE_BUCKET_TTL = int(os.getenv('RATE_BUCKET_TTL', '600'))  # через сколько секунд простоя бакет удаляется
+
+# Остановка бота
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '25'))  # сколько ждать незавершённые обработчики при остановке, сек
+SPOOL_PATH = os.getenv('SPOOL_PATH', 'spool.jsonl')  # необработанные апдейты, повторяются при следующем старте
+
 # Функции БД
 async def init_db():
     async with aiosqlite.connect('users.db') as db:
@@ -27,6 +134,13 @@ async def init_db():
                             (id INTEGER PRIMARY KEY, uses_text INTEGER DEFAULT 20, uses_image INTEGER DEFAULT 10, uses_vision INTEGER DEFAULT 3, uses_code INTEGER DEFAULT 5, premium INTEGER DEFAULT 0)''')
         await db.execute('''CREATE TABLE IF NOT EXISTS messages 
                             (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, timestamp TEXT, role TEXT, content TEXT)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS subscriptions 
+                            (user_id INTEGER PRIMARY KEY, plan TEXT, expires_at INTEGER)''')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions (expires_at)')
+        await db.execute('''CREATE TABLE IF NOT EXISTS usage_hourly 
+                            (user_id INTEGER, hour INTEGER, mode TEXT, model TEXT, requests INTEGER, prompt_tokens INTEGER, cached_tokens INTEGER, completion_tokens INTEGER, latency_ms INTEGER, PRIMARY KEY (user_id, hour, mode, model))''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS usage_hourly_totals 
+                            (hour INTEGER, mode TEXT, model TEXT, requests INTEGER, prompt_tokens INTEGER, cached_tokens INTEGER, completion_tokens INTEGER, latency_ms INTEGER, PRIMARY KEY (hour, mode, model))''')
         await db.commit()
         # Миграция для новых полей
         cursor = await db.execute("PRAGMA table_info(users)")
@@ -35,6 +149,19 @@ async def init_db():
             await db.execute('ALTER TABLE users ADD COLUMN uses_code INTEGER DEFAULT 5')
             await db.commit()
             print("Добавлена колонка uses_code в БД")
+        if 'merge_messages' not in columns:
+            await db.execute('ALTER TABLE users ADD COLUMN merge_messages INTEGER DEFAULT 0')
+            await db.commit()
+            print("Добавлена колонка merge_messages в БД")
+        if 'quota_reset_at' not in columns:
+            await db.execute('ALTER TABLE users ADD COLUMN quota_reset_at INTEGER')
+            await db.execute('UPDATE users SET quota_reset_at = ? WHERE premium = 0', (next_quota_reset(),))
+            # Старые премиум-пользователи без даты окончания получают месяц с момента миграции
+            await db.execute("INSERT OR IGNORE INTO subscriptions (user_id, plan, expires_at) SELECT id, 'legacy', ? FROM users WHERE premium = 1", (int(time.time()) + 30 * 86400,))
+            await db.commit()
+            print("Добавлена колонка quota_reset_at в БД")
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_users_quota_reset_at ON users (quota_reset_at)')
+        await db.commit()
 
 async def get_text_uses(user_id):
     await init_db()
@@ -44,7 +171,7 @@ async def get_text_uses(user_id):
         if row:
             return row[0]
         else:
-            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium) VALUES (?, 20, 10, 3, 5, 0)', (user_id,))
+            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium, quota_reset_at) VALUES (?, 20, 10, 3, 5, 0, ?)', (user_id, next_quota_reset()))
             await db.commit()
             return 20
 
@@ -56,7 +183,7 @@ async def get_image_uses(user_id):
         if row:
             return row[0]
         else:
-            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium) VALUES (?, 20, 10, 3, 5, 0)', (user_id,))
+            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium, quota_reset_at) VALUES (?, 20, 10, 3, 5, 0, ?)', (user_id, next_quota_reset()))
             await db.commit()
             return 10
 
@@ -68,7 +195,7 @@ async def get_vision_uses(user_id):
         if row:
             return row[0]
         else:
-            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium) VALUES (?, 20, 10, 3, 5, 0)', (user_id,))
+            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium, quota_reset_at) VALUES (?, 20, 10, 3, 5, 0, ?)', (user_id, next_quota_reset()))
             await db.commit()
             return 3
 
@@ -80,7 +207,7 @@ async def get_code_uses(user_id):
         if row:
             return row[0]
         else:
-            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium) VALUES (?, 20, 10, 3, 5, 0)', (user_id,))
+            await db.execute('INSERT INTO users (id, uses_text, uses_image, uses_vision, uses_code, premium, quota_reset_at) VALUES (?, 20, 10, 3, 5, 0, ?)', (user_id, next_quota_reset()))
             await db.commit()
             return 5
 
@@ -96,10 +223,10 @@ async def decrement_image_uses(user_id):
         await db.execute('UPDATE users SET uses_image = uses_image - 1 WHERE id = ?', (user_id,))
         await db.commit()
 
-async def decrement_vision_uses(user_id):
+async def decrement_vision_uses(user_id, amount=1):
     await init_db()
     async with aiosqlite.connect('users.db') as db:
-        await db.execute('UPDATE users SET uses_vision = uses_vision - 1 WHERE id = ?', (user_id,))
+        await db.execute('UPDATE users SET uses_vision = uses_vision - ? WHERE id = ?', (amount, user_id))
         await db.commit()
 
 async def decrement_code_uses(user_id):
@@ -112,13 +239,19 @@ async def save_message(user_id, role, content):
     await init_db()
     async with aiosqlite.connect('users.db') as db:
         timestamp = datetime.now().isoformat()
-        await db.execute('INSERT INTO messages (user_id, timestamp, role, content) VALUES (?, ?, ?, ?)', (user_id, timestamp, role, content))
+        cursor = await db.execute('INSERT INTO messages (user_id, timestamp, role, content) VALUES (?, ?, ?, ?)', (user_id, timestamp, role, content))
         await db.commit()
+    add_to_index(user_id, cursor.lastrowid, role, content)
+    return cursor.lastrowid
 
-async def get_message_history(user_id, limit=5):
+async def get_message_history(user_id, limit=5, before_id=None):
     await init_db()
     async with aiosqlite.connect('users.db') as db:
-        cursor = await db.execute('SELECT role, content FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?', (user_id, limit))
+        if before_id is None:
+            cursor = await db.execute('SELECT role, content FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?', (user_id, limit))
+        else:
+            # Всё, что записано до before_id, — без самого вопроса и без сообщений, пришедших позже
+            cursor = await db.execute('SELECT role, content FROM messages WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?', (user_id, before_id, limit))
         rows = await cursor.fetchall()
         return [{'role': row[0], 'content': row[1]} for row in reversed(rows)]
 
@@ -127,37 +260,673 @@ async def clear_history(user_id):
     async with aiosqlite.connect('users.db') as db:
         await db.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
         await db.commit()
+        user_indexes.pop(user_id, None)
+        index_builds.pop(user_id, None)  # идущая сборка прочитала старую историю — её результат не сохраняем
         print(f"История очищена для пользователя {user_id}")
 
+merge_users = set()  # user_id с включённой склейкой; читается на каждом сообщении, поэтому держим в памяти
+
+async def load_merge_settings():
+    await init_db()
+    async with aiosqlite.connect('users.db') as db:
+        cursor = await db.execute('SELECT id FROM users WHERE merge_messages = 1')
+        merge_users.update(row[0] for row in await cursor.fetchall())
+
+async def get_merge_messages(user_id):
+    return 1 if user_id in merge_users else 0
+
+async def set_merge_messages(user_id, value):
+    await init_db()
+    async with aiosqlite.connect('users.db') as db:
+        await db.execute('INSERT OR IGNORE INTO users (id, quota_reset_at) VALUES (?, ?)', (user_id, next_quota_reset()))
+        await db.execute('UPDATE users SET merge_messages = ? WHERE id = ?', (value, user_id))
+        await db.commit()
+    if value:
+        merge_users.add(user_id)
+    else:
+        merge_users.discard(user_id)
+
 async def get_premium_status(user_id):
+    # Без запроса к БД: сроки подписок держатся в памяти (см. load_subscriptions)
+    return 1 if premium_until.get(user_id, 0) > time.time() else 0
+
+# Подписки и сброс лимитов
+premium_until = {}  # user_id -> expires_at (unix)
+expiry_heap = []  # (expires_at, user_id); после продления в куче остаются устаревшие записи
+
+def next_quota_reset():
+    return int(time.time()) + QUOTA_RESET_DAYS * 86400
+
+def schedule_expiry(user_id, expires_at):
+    premium_until[user_id] = expires_at
+    heapq.heappush(expiry_heap, (expires_at, user_id))
+
+async def load_subscriptions():
     await init_db()
     async with aiosqlite.connect('users.db') as db:
-        cursor = await db.execute('SELECT premium FROM users WHERE id = ?', (user_id,))
-        row = await cursor.fetchone()
-        return row[0] if row else 0
+        # Истёкшие, но не понижённые (бот был выключен) тоже попадают в кучу и снимутся первым проходом
+        cursor = await db.execute('SELECT s.user_id, s.expires_at FROM subscriptions s JOIN users u ON u.id = s.user_id WHERE u.premium = 1')
+        for user_id, expires_at in await cursor.fetchall():
+            schedule_expiry(user_id, expires_at)
+    print(f"Загружено подписок: {len(premium_until)}")
+
+async def save_subscription(user_id, plan, expires_at):
+    await init_db()
+    async with aiosqlite.connect('users.db') as db:
+        await db.execute('UPDATE users SET uses_text = 9999, uses_image = 9999, uses_vision = 9999, uses_code = 9999, premium = 1, quota_reset_at = NULL WHERE id = ?', (user_id,))
+        await db.execute('INSERT INTO subscriptions (user_id, plan, expires_at) VALUES (?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET plan = excluded.plan, expires_at = excluded.expires_at', (user_id, plan, expires_at))
+        await db.commit()
+    schedule_expiry(user_id, expires_at)
+
+async def expire_subscriptions():
+    now = time.time()
+    expired = []
+    while expiry_heap and expiry_heap[0][0] <= now:
+        expires_at, user_id = heapq.heappop(expiry_heap)
+        if premium_until.get(user_id) == expires_at:
+            expired.append((expires_at, user_id))
+    if not expired:
+        return
+    reset_at = next_quota_reset()
+    try:
+        async with aiosqlite.connect('users.db') as db:
+            await db.executemany('UPDATE users SET uses_text = 20, uses_image = 10, uses_vision = 3, uses_code = 5, premium = 0, quota_reset_at = ? WHERE id = ? AND NOT EXISTS (SELECT 1 FROM subscriptions WHERE user_id = ? AND expires_at > ?)',
+                                 [(reset_at, user_id, user_id, int(now)) for _, user_id in expired])
+            await db.commit()
+    except Exception:
+        # Запись не прошла — возвращаем подписки в кучу, следующий проход попробует снова
+        for entry in expired:
+            heapq.heappush(expiry_heap, entry)
+        raise
+    # Память меняем только после коммита; за время записи подписку могли продлить
+    for expires_at, user_id in expired:
+        if premium_until.get(user_id) == expires_at:
+            del premium_until[user_id]
+    print(f"Истекли подписки: {len(expired)}")
+
+async def reset_free_quotas():
+    now = int(time.time())
+    async with aiosqlite.connect('users.db') as db:
+        # По индексу quota_reset_at — трогаем только строки, у которых подошёл срок
+        cursor = await db.execute('UPDATE users SET uses_text = 20, uses_image = 10, uses_vision = 3, uses_code = 5, quota_reset_at = ? WHERE quota_reset_at <= ? AND premium = 0',
+                                  (now + QUOTA_RESET_DAYS * 86400, now))
+        await db.commit()
+        if cursor.rowcount:
+            print(f"Пополнены бесплатные лимиты: {cursor.rowcount}")
+
+async def subscription_scheduler():
+    while True:
+        failed = False
+        # Проходы независимы: сбой понижения подписок не должен задерживать пополнение лимитов
+        for sweep in (expire_subscriptions, reset_free_quotas):
+            try:
+                await sweep()
+            except Exception as e:
+                failed = True
+                print(f"Ошибка в планировщике подписок: {e}")
+        delay = SUBSCRIPTION_SWEEP_INTERVAL
+        # После сбоя ждём полный интервал: вернувшиеся в кучу подписки уже просрочены, иначе крутились бы без паузы
+        if expiry_heap and not failed:
+            delay = min(delay, max(0, expiry_heap[0][0] - time.time()))
+        await asyncio.sleep(delay)
+
+# Учёт использования OpenAI: счётчики в памяти, периодический сброс в почасовые таблицы
+usage_counters = {}  # (hour, user_id, mode, model) -> [requests, prompt, cached, completion, latency_ms]
+
+cache_stats = {'hit': [0, 0.0], 'miss': [0, 0.0]}  # запросов и суммарная задержка с кэшем промпта и без
+
+def cached_tokens(usage):
+    details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+    return (details.cached_tokens or 0) if details else 0
+
+def record_usage(user_id, mode, model, usage, latency):
+    hour = int(time.time()) // 3600 * 3600
+    counters = usage_counters.setdefault((hour, user_id, mode, model), [0, 0, 0, 0, 0])
+    counters[0] += 1
+    if usage:
+        counters[1] += usage.prompt_tokens
+        counters[2] += cached_tokens(usage)
+        counters[3] += usage.completion_tokens
+    counters[4] += int(latency * 1000)
+    bucket = cache_stats['hit' if cached_tokens(usage) else 'miss']
+    bucket[0] += 1
+    bucket[1] += latency
+
+def merge_usage(target, key, values):
+    counters = target.setdefault(key, [0, 0, 0, 0, 0])
+    for i, value in enumerate(values):
+        counters[i] += value
+
+async def flush_usage():
+    global usage_counters
+    if not usage_counters:
+        return
+    pending, usage_counters = usage_counters, {}
+    totals = {}
+    for (hour, user_id, mode, model), values in pending.items():
+        merge_usage(totals, (hour, mode, model), values)
+    try:
+        await init_db()
+        async with aiosqlite.connect('users.db') as db:
+            await db.executemany('''INSERT INTO usage_hourly (hour, user_id, mode, model, requests, prompt_tokens, cached_tokens, completion_tokens, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT(user_id, hour, mode, model) DO UPDATE SET requests = requests + excluded.requests, prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                                    cached_tokens = cached_tokens + excluded.cached_tokens, completion_tokens = completion_tokens + excluded.completion_tokens, latency_ms = latency_ms + excluded.latency_ms''',
+                                 [(*key, *values) for key, values in pending.items()])
+            await db.executemany('''INSERT INTO usage_hourly_totals (hour, mode, model, requests, prompt_tokens, cached_tokens, completion_tokens, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT(hour, mode, model) DO UPDATE SET requests = requests + excluded.requests, prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                                    cached_tokens = cached_tokens + excluded.cached_tokens, completion_tokens = completion_tokens + excluded.completion_tokens, latency_ms = latency_ms + excluded.latency_ms''',
+                                 [(*key, *values) for key, values in totals.items()])
+            await db.commit()
+    except Exception:
+        # Не теряем счётчики: вернём их и попробуем при следующем сбросе
+        for key, values in pending.items():
+            merge_usage(usage_counters, key, values)
+        raise
+
+async def usage_flusher():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            await flush_usage()
+        except Exception as e:
+            print(f"Ошибка сброса статистики: {e}")
+
+def usage_cost(model, prompt_tokens, cached_tokens, completion_tokens):
+    price_in, price_cached, price_out = MODEL_PRICES.get(model, MODEL_PRICES['gpt-4o-mini'])
+    return ((prompt_tokens - cached_tokens) * price_in + cached_tokens * price_cached + completion_tokens * price_out) / 1_000_000
+
+async def get_usage_stats(user_id=None, hours=24):
+    # Читает только предагрегированные строки за последние сутки — их число не зависит от трафика
+    since = int(time.time()) // 3600 * 3600 - (hours - 1) * 3600
+    await init_db()
+    async with aiosqlite.connect('users.db') as db:
+        if user_id is None:
+            cursor = await db.execute('SELECT mode, model, SUM(requests), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), SUM(latency_ms) FROM usage_hourly_totals WHERE hour >= ? GROUP BY mode, model', (since,))
+        else:
+            cursor = await db.execute('SELECT mode, model, SUM(requests), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), SUM(latency_ms) FROM usage_hourly WHERE user_id = ? AND hour >= ? GROUP BY mode, model', (user_id, since))
+        return await cursor.fetchall()
+
+# Промпты: системный префикс по режимам. Тексты менять только вместе с PROMPT_VERSION —
+# любой изменённый байт в префиксе сбрасывает кэш промптов у провайдера
+PROMPT_VERSION = 'v1'
+SYSTEM_PROMPTS = {
+    'text': "Ты полезный AI-ассистент. Отвечай на русском языке, понятно и по делу.",
+    'code': "Ты ассистент по программированию. Генерируй код с объяснением на русском языке. Используй markdown для кода (```python ... ```).",
+    'vision': "Ты полезный AI-аналитик изображений на русском языке. Опиши, что на фото, или сгенерируй подпись, если попросили.",
+}
+
+def build_messages(mode, history, turn, context=()):
+    # Порядок фиксирован: статический префикс, история, найденные старые фрагменты и новый ход.
+    # Фрагменты меняются с каждым запросом, поэтому стоят после истории, чтобы не ломать кэшируемый префикс
+    messages = [{"role": "system", "content": SYSTEM_PROMPTS[mode]}]
+    messages.extend({"role": msg['role'], "content": msg['content']} for msg in history)
+    if context:
+        fragments = "\n".join(f"{msg['role']}: {msg['content']}" for msg in context)
+        messages.append({"role": "system", "content": f"Фрагменты более ранней переписки:\n{fragments}"})
+    messages.append({"role": "user", "content": turn})
+    return messages
+
+# Локальный индекс по всей истории: хэш-векторы слов в float32-матрице на пользователя
+user_indexes = OrderedDict()  # user_id -> {'vectors': np.ndarray, 'size': int, 'turns': [...]}, LRU
+index_builds = {}  # user_id -> задача сборки индекса
+pending_adds = {}  # user_id -> [(message_id, role, content)], сообщения, записанные во время сборки
+
+def embed(text):
+    # Триграммы символов внутри слов: «кот» и «кота» получают общие признаки без морфологии
+    vector = np.zeros(RETRIEVAL_DIM, dtype=np.float32)
+    for word in re.findall(r'\w+', text.lower()):
+        word = f'#{word}#'
+        for i in range(len(word) - 2):
+            h = zlib.crc32(word[i:i + 3].encode())
+            vector[h % RETRIEVAL_DIM] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def index_capacity(size):
+    # Растём в полтора раза, а не вдвое: меньше пустых строк на каждого пользователя
+    return max(16, size + size // 2)
+
+def build_index(rows):
+    turns = [{'role': role, 'content': content} for role, content in rows if isinstance(content, str)]
+    vectors = np.zeros((index_capacity(len(turns)), RETRIEVAL_DIM), dtype=np.float32)
+    for i, turn in enumerate(turns):
+        vectors[i] = embed(turn['content'])
+    return {'vectors': vectors, 'size': len(turns), 'turns': turns}
+
+def add_to_index(user_id, message_id, role, content):
+    if not isinstance(content, str):
+        return
+    index = user_indexes.get(user_id)
+    if index is None:
+        if user_id in pending_adds:
+            pending_adds[user_id].append((message_id, role, content))
+        return  # Индекс строится лениво при первом поиске
+    if index['size'] == len(index['vectors']):
+        grown = np.zeros((index_capacity(index['size']), RETRIEVAL_DIM), dtype=np.float32)
+        grown[:index['size']] = index['vectors']
+        index['vectors'] = grown
+        trim_indexes()
+    index['vectors'][index['size']] = embed(content)
+    index['turns'].append({'role': role, 'content': content})
+    index['size'] += 1
+
+def trim_indexes():
+    # Вытесняем давно не использованные индексы, пока не уложимся и по числу пользователей, и по строкам
+    rows = sum(len(index['vectors']) for index in user_indexes.values())
+    while len(user_indexes) > 1 and (len(user_indexes) > RETRIEVAL_MAX_USERS or rows > RETRIEVAL_MAX_ROWS):
+        _, index = user_indexes.popitem(last=False)
+        rows -= len(index['vectors'])
+
+async def build_user_index(user_id):
+    pending = pending_adds[user_id] = []
+    try:
+        await init_db()
+        async with aiosqlite.connect('users.db') as db:
+            cursor = await db.execute('SELECT id, role, content FROM messages WHERE user_id = ? ORDER BY id', (user_id,))
+            rows = await cursor.fetchall()
+        index = await asyncio.to_thread(build_index, [(role, content) for _, role, content in rows])
+        if index_builds.get(user_id) is not asyncio.current_task():
+            return build_index([])  # историю очистили во время сборки
+        user_indexes[user_id] = index
+        # Сообщения, сохранённые пока шли чтение и сборка, дописываем; уже прочитанные пропускаем по id
+        last_id = rows[-1][0] if rows else 0
+        for message_id, role, content in pending:
+            if message_id > last_id:
+                add_to_index(user_id, message_id, role, content)
+        trim_indexes()
+        return index
+    finally:
+        if pending_adds.get(user_id) is pending:
+            del pending_adds[user_id]
+        if index_builds.get(user_id) is asyncio.current_task():
+            del index_builds[user_id]
+
+async def load_index(user_id):
+    index = user_indexes.get(user_id)
+    if index is not None:
+        user_indexes.move_to_end(user_id)
+        return index
+    if user_id not in index_builds:
+        index_builds[user_id] = asyncio.create_task(build_user_index(user_id))
+    # Одновременные запросы ждут одну сборку; отмена одного из них её не прерывает
+    return await asyncio.shield(index_builds[user_id])
+
+async def retrieve_context(user_id, query, skip_recent):
+    # Возвращает до RETRIEVAL_TOP_K старых сообщений, похожих на запрос, не считая последних skip_recent
+    if not RETRIEVAL_ENABLED:
+        return []
+    index = await load_index(user_id)
+    count = index['size'] - skip_recent
+    if count <= 0:
+        return []
+    scores = index['vectors'][:count] @ embed(query)
+    k = min(RETRIEVAL_TOP_K, count)
+    best = np.argpartition(-scores, k - 1)[:k]
+    chosen, budget = [], RETRIEVAL_TOKEN_BUDGET
+    for i in sorted(best, key=lambda i: -scores[i]):
+        tokens = len(index['turns'][i]['content']) // 3 + 1
+        if scores[i] < RETRIEVAL_MIN_SCORE or tokens > budget:
+            continue
+        chosen.append(i)
+        budget -= tokens
+    return [index['turns'][i] for i in sorted(chosen)]
+
+# Маршрутизация запросов к OpenAI
+model_health = {}  # model -> {'token_latency': EWMA секунд на токен ответа, 'failures': ошибок подряд, 'down_until': monotonic}
+truncated_stats = {}  # 'mode/reason/max_tokens' -> сколько ответов упёрлось в max_tokens
+
+def message_text(msg):
+    if isinstance(msg['content'], str):
+        return msg['content']
+    return ' '.join(part.get('text', '') for part in msg['content'])
+
+def prompt_size(messages):
+    return sum(len(message_text(msg)) for msg in messages)
+
+def is_small_talk(text):
+    words = re.findall(r'\w+', text.lower())
+    return bool(words) and all(word in SMALL_TALK_WORDS for word in words)
+
+def model_is_healthy(model):
+    return model_health.get(model, {}).get('down_until', 0) <= time.monotonic()
+
+def record_model_result(model, latency, ok, completion_tokens=0):
+    health = model_health.setdefault(model, {'token_latency': None, 'failures': 0, 'down_until': 0})
+    if ok:
+        health['failures'] = 0
+        per_token = latency / max(completion_tokens, MODEL_MIN_TOKENS)
+        health['token_latency'] = per_token if health['token_latency'] is None else 0.8 * health['token_latency'] + 0.2 * per_token
+        slow = health['token_latency'] > MODEL_TOKEN_LATENCY_SLO
+    else:
+        health['failures'] += 1
+        slow = False
+    if slow or health['failures'] >= MODEL_MAX_FAILURES:
+        # После паузы модель снова пробуется с чистой статистикой
+        health.update(token_latency=None, failures=0, down_until=time.monotonic() + MODEL_COOLDOWN)
+        print(f"Модель {model} временно отключена ({'медленно' if slow else 'ошибки'})")
+
+def choose_route(mode, is_premium, prompt_chars, turn):
+    route = MODEL_ROUTES[mode]['premium' if is_premium else 'free']
+    model = route['model']
+    reason = 'default'
+    if prompt_chars >= LARGE_PROMPT_CHARS and route.get('large_model'):
+        model, reason = route['large_model'], 'large'
+    max_tokens = route['max_tokens']
+    if route.get('short_max_tokens') and is_small_talk(turn):
+        max_tokens, reason = route['short_max_tokens'], 'short'
+    fallback = route.get('fallback')
+    if fallback and not model_is_healthy(model) and model_is_healthy(fallback):
+        model, fallback, reason = fallback, model, 'unhealthy'
+    return {'model': model, 'fallback': fallback, 'max_tokens': max_tokens, 'temperature': route['temperature'], 'reason': reason}
+
+async def complete(mode, user_id, is_premium, messages):
+    prompt_chars = prompt_size(messages)
+    route = choose_route(mode, is_premium, prompt_chars, message_text(messages[-1]))
+    models = [route['model']] + ([route['fallback']] if route['fallback'] else [])
+    for i, model in enumerate(models):
+        started = time.monotonic()
+        try:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=route['max_tokens'],
+                temperature=route['temperature']
+            )
+        except (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError) as e:
+            record_model_result(model, time.monotonic() - started, False)
+            if i == len(models) - 1:
+                raise
+            print(f"Routing: {model} недоступна ({e}), пробую {models[i + 1]}")
+            continue
+        latency = time.monotonic() - started
+        record_model_result(model, latency, True, getattr(response.usage, 'completion_tokens', 0) or 0)
+        record_usage(user_id, mode, model, response.usage, latency)
+        reason = route['reason'] if i == 0 else 'fallback'
+        finish_reason = response.choices[0].finish_reason
+        if finish_reason == 'length':
+            # Ответ обрезан лимитом max_tokens — сигнал поднять лимит для этого маршрута
+            key = f"{mode}/{reason}/{route['max_tokens']}"
+            truncated_stats[key] = truncated_stats.get(key, 0) + 1
+        print(f"Routing: mode={mode} premium={bool(is_premium)} prompt_chars={prompt_chars} model={model} reason={reason} "
+              f"max_tokens={route['max_tokens']} finish={finish_reason} prompt={PROMPT_VERSION} cached_tokens={cached_tokens(response.usage)} latency={latency:.2f}s ewma={(model_health[model]['token_latency'] or 0) * 1000:.1f}ms/tok")
+        return response
+
+# Очередь исходящих сообщений
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        # Сколько секунд ждать до свободного токена (0 — можно сейчас)
+        self.refill()
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - time.monotonic())
+
+    def pause(self, seconds):
+        # После паузы бакет стартует пустым, чтобы не выстрелить запасом сразу
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    def take(self):
+        self.tokens -= 1
+
+global_send_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+chat_send_buckets = {}  # chat_id -> TokenBucket
+outbound_queue = asyncio.PriorityQueue()  # (приоритет, seq, chat_id, время постановки, вызов, future)
+outbound_delayed = []  # (готово в monotonic, элемент очереди): чат ещё не готов, воркер не ждёт его
+outbound_delay_event = asyncio.Event()
+outbound_seq = itertools.count()
+recent_floods = {}  # chat_id -> monotonic последнего TelegramRetryAfter
+outbound_stats = {'sent': 0, 'retry_after': 0, 'latency_total': 0.0, 'latency_max': 0.0, 'queue_max': 0}
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # Режем по строкам; незакрытый блок ``` закрываем в конце части и открываем заново в следующей
+    if not text or len(text) <= limit:
+        return [text]
+    chunks = []
+    current = ''
+    fence = None
+    for line in text.splitlines(keepends=True):
+        fence_after = fence
+        if line.lstrip().startswith('```'):
+            fence_after = None if fence else line.lstrip()[:20].rstrip('\n') + '\n'
+        for i in range(0, len(line), limit // 2):
+            piece = line[i:i + limit // 2]
+            # Если после этой части блок кода открыт, оставляем место под закрывающий "\n```"
+            if current and len(current) + len(piece) + (4 if fence_after else 0) > limit:
+                chunks.append(current + ('' if current.endswith('\n') else '\n') + '```' if fence else current)
+                current = fence or ''
+            current += piece
+        fence = fence_after
+    if current:
+        chunks.append(current)
+    assert all(len(chunk) <= limit for chunk in chunks)
+    return chunks
+
+def chat_send_bucket(chat_id):
+    bucket = chat_send_buckets.get(chat_id)
+    if bucket is None:
+        if len(chat_send_buckets) > 10000:
+            # Полные бакеты ничем не отличаются от новых — выкидываем их
+            for key in [key for key, b in chat_send_buckets.items() if b.wait_time() == 0 and b.tokens >= b.burst]:
+                del chat_send_buckets[key]
+        bucket = chat_send_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+    return bucket
+
+def delay_outbound(item, wait):
+    # Элемент остаётся «незавершённым» для outbound_queue.join(): task_done вызовет насос при возврате в очередь
+    heapq.heappush(outbound_delayed, (time.monotonic() + wait, item))
+    outbound_delay_event.set()
+
+async def outbound_delay_pump():
+    while True:
+        now = time.monotonic()
+        while outbound_delayed and outbound_delayed[0][0] <= now:
+            _, item = heapq.heappop(outbound_delayed)
+            outbound_queue.put_nowait(item)
+            outbound_queue.task_done()
+        timeout = outbound_delayed[0][0] - now if outbound_delayed else None
+        outbound_delay_event.clear()
+        try:
+            await asyncio.wait_for(outbound_delay_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def register_flood(chat_id, retry_after):
+    # retry_after относится к чату; если флуд ловят сразу несколько чатов — это общий лимит бота
+    now = time.monotonic()
+    recent_floods[chat_id] = now
+    for key in [key for key, at in recent_floods.items() if now - at > OUTBOUND_FLOOD_WINDOW]:
+        del recent_floods[key]
+    chat_send_bucket(chat_id).pause(retry_after)
+    if len(recent_floods) >= OUTBOUND_GLOBAL_FLOOD_CHATS:
+        global_send_bucket.pause(retry_after)
+        print(f"Flood control: общая пауза {retry_after} сек ({len(recent_floods)} чатов)")
+    else:
+        print(f"Flood control: пауза {retry_after} сек (chat={chat_id})")
+
+async def outbound_worker():
+    while True:
+        item = await outbound_queue.get()
+        _, _, chat_id, enqueued, make_call, future = item
+        try:
+            bucket = chat_send_bucket(chat_id)
+            wait = bucket.wait_time()
+            if wait > 0:
+                # Чат упёрся в свой лимит — откладываем, воркер берёт следующий элемент
+                delay_outbound(item, wait)
+                continue
+            # Общий лимит касается всех чатов, поэтому его можно подождать прямо здесь
+            while (wait := global_send_bucket.wait_time()) > 0:
+                await asyncio.sleep(wait)
+            global_send_bucket.take()
+            bucket.take()
+            try:
+                result = await make_call()
+            except TelegramRetryAfter as e:
+                outbound_stats['retry_after'] += 1
+                register_flood(chat_id, e.retry_after)
+                delay_outbound(item, e.retry_after)
+                continue
+            latency = time.monotonic() - enqueued
+            outbound_stats['sent'] += 1
+            outbound_stats['latency_total'] += latency
+            outbound_stats['latency_max'] = max(outbound_stats['latency_max'], latency)
+            if outbound_stats['sent'] % 100 == 0:
+                print(f"Outbound: sent={outbound_stats['sent']} queue={(outbound_queue.qsize() + len(outbound_delayed))} queue_max={outbound_stats['queue_max']} avg_latency={outbound_stats['latency_total'] / outbound_stats['sent']:.2f}s max_latency={outbound_stats['latency_max']:.2f}s retry_after={outbound_stats['retry_after']}")
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        outbound_queue.task_done()
+
+async def send_queued(chat_id, make_call, premium=False):
+    # Все исходящие вызовы Telegram идут через очередь; премиум-чаты обслуживаются первыми
+    future = asyncio.get_running_loop().create_future()
+    await outbound_queue.put((0 if premium else 1, next(outbound_seq), chat_id, time.monotonic(), make_call, future))
+    outbound_stats['queue_max'] = max(outbound_stats['queue_max'], (outbound_queue.qsize() + len(outbound_delayed)))
+    return await future
+
+async def send_reply(message, text, premium=False, **kwargs):
+    chunks = split_message(text)
+    for i, chunk in enumerate(chunks):
+        # Клавиатура прикрепляется к последней части, ответом на сообщение — первая
+        extra = kwargs if i == len(chunks) - 1 else {k: v for k, v in kwargs.items() if k != 'reply_markup'}
+        send = message.reply if i == 0 else message.answer
+        await send_queued(message.chat.id, lambda send=send, chunk=chunk, extra=extra: send(chunk, **extra), premium)
 
 # Функции инвойсов
 async def send_standard_invoice(message_or_query):
-    await bot.send_invoice(
-        chat_id=message_or_query.chat.id if hasattr(message_or_query, 'chat') else message_or_query.message.chat.id,
+    chat_id = message_or_query.chat.id if hasattr(message_or_query, 'chat') else message_or_query.message.chat.id
+    await send_queued(chat_id, lambda: bot.send_invoice(
+        chat_id=chat_id,
         title="Стандартная подписка на AI-бота",
         description="Unlimited доступ к нейросети на 1 месяц: генерация текста, изображений, анализ фото, код. 20 текст + 10 изображений + 3 анализа + 5 кода вначале, потом unlimited. Идеально для повседневного использования. Поддержка на русском. Нет рекламы.",
         payload="standard_200rub",
         provider_token=PAYMENT_TOKEN,
         currency="RUB",
         prices=[LabeledPrice(label="Стандарт (1 месяц)", amount=20000)]
-    )
+    ))
 
 async def send_premium_invoice(message_or_query):
-    await bot.send_invoice(
-        chat_id=message_or_query.chat.id if hasattr(message_or_query, 'chat') else message_or_query.message.chat.id,
+    chat_id = message_or_query.chat.id if hasattr(message_or_query, 'chat') else message_or_query.message.chat.id
+    await send_queued(chat_id, lambda: bot.send_invoice(
+        chat_id=chat_id,
         title="Премиум подписка на AI-бота",
         description="Unlimited доступ на 3 месяца: генерация текста, изображений (Stable Diffusion), анализ фото, код. 20 текст + 10 изображений + 3 анализа + 5 кода вначале, потом unlimited с приоритетом. Дополнительно: история чата. Идеально для креатива и бизнеса. Поддержка на русском. Нет рекламы.",
         payload="premium_500rub",
         provider_token=PAYMENT_TOKEN,
         currency="RUB",
         prices=[LabeledPrice(label="Премиум (3 месяца)", amount=50000)]
-    )
+    ))
+
+# Подготовка фото для анализа
+def pick_photo_size(photo_sizes):
+    # Telegram отдаёт размеры по возрастанию: берём первый, который не меньше целевого
+    for size in photo_sizes:
+        if max(size.width, size.height) >= VISION_TARGET_SIDE:
+            return size
+    return photo_sizes[-1]
+
+def estimate_image_tokens(width, height, detail=VISION_DETAIL):
+    # Оценка по правилам OpenAI: low — фиксированная цена, high — плитки 512x512
+    if detail == 'low':
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+def downscale_image(data):
+    # Выполняется в пуле потоков, чтобы не блокировать event loop
+    if Image is None:
+        return data
+    with Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= VISION_TARGET_SIDE:
+            return data
+        img.thumbnail((VISION_TARGET_SIDE, VISION_TARGET_SIDE))
+        out = io.BytesIO()
+        img.convert('RGB').save(out, format='JPEG', quality=VISION_JPEG_QUALITY)
+        return out.getvalue()
+
+async def prepare_vision_image(photo_sizes):
+    size = pick_photo_size(photo_sizes)
+    buffer = await bot.download(size.file_id, destination=io.BytesIO())
+    data = await asyncio.to_thread(downscale_image, buffer.getvalue())
+    scale = min(1.0, VISION_TARGET_SIDE / max(size.width, size.height))
+    image_tokens = estimate_image_tokens(size.width * scale, size.height * scale)
+    image_url = f"data:image/jpeg;base64,{base64.b64encode(data).decode()}"
+    return image_url, image_tokens
+
+# Анализ фото (одиночное фото или альбом)
+async def analyze_photos(messages):
+    message = messages[0]
+    try:
+        user_id = message.from_user.id
+        is_premium = await get_premium_status(user_id)
+        uses_vision_left = await get_vision_uses(user_id)
+        if is_premium or uses_vision_left > 0:
+            if not is_premium:
+                if MEDIA_GROUP_QUOTA == 'image':
+                    messages = messages[:uses_vision_left]  # Анализируем столько фото, сколько осталось попыток
+                    await decrement_vision_uses(user_id, len(messages))
+                else:
+                    await decrement_vision_uses(user_id)
+            # Скачивание фото в память (минимальный подходящий размер) и inline base64
+            started = time.monotonic()
+            images = await asyncio.gather(*(prepare_vision_image(m.photo) for m in messages))
+            image_tokens = sum(tokens for _, tokens in images)
+            # GPT Vision анализ
+            prompt = next((m.caption for m in messages if m.caption), None) or "Что на этом фото?"
+            response = await complete('vision', user_id, is_premium, build_messages('vision', [], [
+                {"type": "text", "text": prompt},
+                *({"type": "image_url", "image_url": {"url": image_url, "detail": VISION_DETAIL}} for image_url, _ in images)
+            ]))
+            latency = time.monotonic() - started
+            prompt_tokens = response.usage.prompt_tokens if response.usage else None
+            print(f"Vision: user={user_id} images={len(images)} image_tokens~{image_tokens} prompt_tokens={prompt_tokens} latency={latency:.2f}s")
+            answer = response.choices[0].message.content
+            await send_reply(message, answer, premium=is_premium)
+            await save_message(user_id, 'assistant', answer)
+        else:
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
+                [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
+            ])
+            await send_reply(message, "Лимит на анализ фото исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
+    except Exception as e:
+        print(f"Ошибка в handle_photo: {str(e)}")
+        await send_reply(message, "Ошибка анализа фото: попробуй позже.")
+
+# Сборка альбомов: Telegram присылает каждое фото альбома отдельным апдейтом
+media_groups = {}  # media_group_id -> {'messages': [...], 'task': asyncio.Task}
+
+def collect_media_group(message):
+    group = media_groups.setdefault(message.media_group_id, {'messages': [], 'task': None})
+    group['messages'].append(message)
+    if group['task']:
+        group['task'].cancel()
+    group['task'] = asyncio.create_task(flush_media_group(message.media_group_id))
+
+async def flush_media_group(media_group_id):
+    await asyncio.sleep(MEDIA_GROUP_WINDOW)
+    group = media_groups.pop(media_group_id)
+    messages = sorted(group['messages'], key=lambda m: m.message_id)[:MEDIA_GROUP_MAX_IMAGES]
+    with track_inflight():
+        await analyze_photos(messages)
 
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
@@ -172,6 +941,76 @@ reply_kb = types.ReplyKeyboardMarkup(
     ],
     resize_keyboard=True
 )
+MENU_BUTTONS = {button.text for row in reply_kb.keyboard for button in row}
+BOT_COMMANDS = {'start', 'help', 'pay', 'merge', 'stats'}  # зарегистрированные команды, не считаются лимитом
+
+def detect_mode(text):
+    text_lower = text.lower()
+    if any(word in text_lower for word in ['нарисуй', 'draw', 'generate image', 'картинка', 'изображение', 'picture']):
+        return 'image'
+    if any(word in text_lower for word in ['код', 'напиши код', 'code', 'программа']):
+        return 'code'
+    return 'text'
+
+# Ограничение частоты: отсекаем лишние запросы до любых обращений к БД и OpenAI
+rate_buckets = {}  # (user_id, mode, tier) -> TokenBucket
+rate_notified = {}  # user_id -> monotonic, до которого предупреждение уже отправлено
+rate_limit_stats = {'shed': {'text': 0, 'code': 0, 'image': 0, 'vision': 0}, 'notices': 0}
+rate_last_sweep = time.monotonic()
+
+def rate_limit_mode(message):
+    if message.successful_payment:
+        return None
+    if message.photo:
+        if message.media_group_id and message.media_group_id in media_groups:
+            return None  # Альбом учитывается один раз, по первому фото
+        return 'vision'
+    if not message.text:
+        return 'text'  # Стикеры, голосовые, документы — тоже в бакет, иначе ими можно флудить
+    if message.text in MENU_BUTTONS:
+        return None
+    if message.text.startswith('/') and (message.text[1:].split(maxsplit=1) or [''])[0].split('@')[0].lower() in BOT_COMMANDS:
+        return None  # Неизвестные команды уходят в handle_message и считаются как обычный текст
+    if message.from_user.id in text_bursts:
+        return None  # Склейка: платит только первое сообщение пачки, как и альбом
+    return detect_mode(message.text)
+
+def sweep_rate_buckets():
+    global rate_last_sweep
+    now = time.monotonic()
+    rate_last_sweep = now
+    for key in [key for key, bucket in rate_buckets.items() if now - bucket.updated > RATE_BUCKET_TTL]:
+        del rate_buckets[key]
+    for user_id in [user_id for user_id, until in rate_notified.items() if until <= now]:
+        del rate_notified[user_id]
+    print(f"Rate limit: buckets={len(rate_buckets)} shed={rate_limit_stats['shed']} notices={rate_limit_stats['notices']}")
+
+@dp.message.outer_middleware()
+async def rate_limit_middleware(handler, message, data):
+    if message.from_user is None:
+        return await handler(message, data)
+    mode = rate_limit_mode(message)
+    if mode is None:
+        return await handler(message, data)
+    if time.monotonic() - rate_last_sweep > RATE_BUCKET_TTL:
+        sweep_rate_buckets()
+    user_id = message.from_user.id
+    tier = 'premium' if await get_premium_status(user_id) else 'free'
+    bucket = rate_buckets.get((user_id, mode, tier))
+    if bucket is None:
+        burst, per_minute = RATE_LIMITS[tier][mode]
+        bucket = rate_buckets[(user_id, mode, tier)] = TokenBucket(per_minute / 60, burst)
+    wait = bucket.wait_time()
+    if wait == 0:
+        bucket.take()
+        return await handler(message, data)
+    rate_limit_stats['shed'][mode] += 1
+    now = time.monotonic()
+    if rate_notified.get(user_id, 0) <= now:
+        # Одно предупреждение на окно ожидания, остальные запросы отбрасываются молча
+        rate_notified[user_id] = now + wait
+        rate_limit_stats['notices'] += 1
+        await send_reply(message, f"Слишком много запросов. Подожди {math.ceil(wait)} сек.")
 
 @dp.message(Command('start'))
 async def start(message: types.Message):
@@ -185,11 +1024,11 @@ async def start(message: types.Message):
             [InlineKeyboardButton(text="💳 Подписка", callback_data="pay")],
             [InlineKeyboardButton(text="❓ Помощь", callback_data="help")]
         ])
-        await message.reply("Привет! Я бот с AI. Выбери действие:", reply_markup=keyboard)
-        await message.answer("Постоянные кнопки внизу для быстрого доступа.", reply_markup=reply_kb)
+        await send_reply(message, "Привет! Я бот с AI. Выбери действие:", reply_markup=keyboard)
+        await send_queued(message.chat.id, lambda: message.answer("Постоянные кнопки внизу для быстрого доступа.", reply_markup=reply_kb))
     except Exception as e:
         print(f"Ошибка в /start: {e}")
-        await message.reply("Ошибка бота. Попробуй позже.")
+        await send_reply(message, "Ошибка бота. Попробуй позже.")
 
 @dp.message(Command('help'))
 async def help_command(message: types.Message):
@@ -205,8 +1044,9 @@ async def help_command(message: types.Message):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
     """
-    await message.reply(help_text, parse_mode="Markdown")
+    await send_reply(message, help_text, parse_mode="Markdown")
 
 @dp.message(Command('pay'))
 async def pay(message: types.Message):
@@ -215,10 +1055,58 @@ async def pay(message: types.Message):
             [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
             [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
         ])
-        await message.reply("Выбери тариф для подписки на AI:", reply_markup=keyboard)
+        await send_reply(message, "Выбери тариф для подписки на AI:", reply_markup=keyboard)
     except Exception as e:
         print(f"Ошибка в /pay: {e}")
-        await message.reply("Ошибка с оплатой.")
+        await send_reply(message, "Ошибка с оплатой.")
+
+@dp.message(Command('merge'))
+async def merge_command(message: types.Message):
+    try:
+        enabled = not await get_merge_messages(message.from_user.id)
+        await set_merge_messages(message.from_user.id, int(enabled))
+        if enabled:
+            await send_reply(message, "Склейка включена: сообщения, отправленные подряд, уйдут в AI одним запросом.")
+        else:
+            await send_reply(message, "Склейка выключена: отвечаю на каждое сообщение отдельно.")
+    except Exception as e:
+        print(f"Ошибка в /merge: {e}")
+        await send_reply(message, "Ошибка бота. Попробуй позже.")
+
+@dp.message(Command('stats'))
+async def stats_command(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    try:
+        args = message.text.split()
+        user_id = int(args[1]) if len(args) > 1 else None
+        rows = await get_usage_stats(user_id)
+        lines = [f"Статистика за 24 часа{f' (пользователь {user_id})' if user_id else ''}:"]
+        total_cost = 0.0
+        for mode, model, requests_count, prompt_tokens, cached, completion_tokens, latency_ms in rows:
+            cost = usage_cost(model, prompt_tokens, cached, completion_tokens)
+            total_cost += cost
+            cache_ratio = cached / prompt_tokens * 100 if prompt_tokens else 0
+            lines.append(f"{mode} / {model}: {requests_count} запр., вход {prompt_tokens} (кэш {cached}, {cache_ratio:.0f}%), выход {completion_tokens}, "
+                         f"ср. задержка {latency_ms / requests_count / 1000:.2f} с, ${cost:.4f}")
+        lines.append(f"Итого: ${total_cost:.4f}")
+        (hits, hit_latency), (misses, miss_latency) = cache_stats['hit'], cache_stats['miss']
+        if hits or misses:
+            lines.append(f"Кэш промпта ({PROMPT_VERSION}): попаданий {hits / (hits + misses) * 100:.0f}%, ср. задержка "
+                         f"{hit_latency / hits if hits else 0:.2f} с с кэшем / {miss_latency / misses if misses else 0:.2f} с без")
+        if outbound_stats['sent']:
+            lines.append(f"Очередь отправки: сейчас {(outbound_queue.qsize() + len(outbound_delayed))}, макс. {outbound_stats['queue_max']}, "
+                         f"ср. задержка {outbound_stats['latency_total'] / outbound_stats['sent']:.2f} с, retry_after {outbound_stats['retry_after']}")
+        if truncated_stats:
+            lines.append(f"Обрезано по max_tokens: {truncated_stats}")
+        if any(rate_limit_stats['shed'].values()):
+            lines.append(f"Отсечено лимитом частоты: {rate_limit_stats['shed']}, предупреждений {rate_limit_stats['notices']}")
+        if debounce_stats['calls']:
+            lines.append(f"Склейка: {debounce_stats['messages'] / debounce_stats['calls']:.2f} сообщ./запрос, сэкономлено {debounce_stats['messages'] - debounce_stats['calls']} запросов")
+        await send_reply(message, "\n".join(lines))
+    except Exception as e:
+        print(f"Ошибка в /stats: {e}")
+        await send_reply(message, "Ошибка статистики.")
 
 @dp.callback_query(lambda c: c.data in ['pay_standard', 'pay_premium'])
 async def process_callback(callback: types.CallbackQuery):
@@ -240,69 +1128,38 @@ async def pre_checkout(pre_checkout_query: PreCheckoutQuery):
 async def successful_payment(message: types.Message):
     try:
         user_id = message.from_user.id
-        await init_db()
-        async with aiosqlite.connect('users.db') as db:
-            await db.execute('UPDATE users SET uses_text = 9999, uses_image = 9999, uses_vision = 9999, uses_code = 9999, premium = 1 WHERE id = ?', (user_id,))
-            await db.commit()
-        await message.reply("Оплата прошла успешно! Теперь у тебя unlimited доступ. Наслаждайся! 🚀")
+        plan = message.successful_payment.invoice_payload
+        # Продление считается от текущей даты окончания, если подписка ещё активна
+        expires_at = int(max(time.time(), premium_until.get(user_id, 0))) + PLAN_DAYS.get(plan, 30) * 86400
+        await save_subscription(user_id, plan, expires_at)
+        until = datetime.fromtimestamp(expires_at).strftime('%d.%m.%Y')
+        await send_reply(message, f"Оплата прошла успешно! Теперь у тебя unlimited доступ до {until}. Наслаждайся! 🚀")
     except Exception as e:
         print(f"Ошибка в successful_payment: {e}")
-        await message.reply("Ошибка после оплаты.")
+        await send_reply(message, "Ошибка после оплаты.")
 
 @dp.message(F.photo)  # Handler для фото
 async def handle_photo(message: types.Message):
-    try:
-        user_id = message.from_user.id
-        is_premium = await get_premium_status(user_id)
-        uses_vision_left = await get_vision_uses(user_id)
-        if is_premium or uses_vision_left > 0:
-            await decrement_vision_uses(user_id) if not is_premium else None
-            # Скачивание файла фото
-            file_id = message.photo[-1].file_id
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
-            photo_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_path}"
-            # GPT Vision анализ
-            prompt = message.caption or "Что на этом фото?"
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты полезный AI-аналитик изображений на русском языке. Опиши, что на фото, или сгенерируй подпись, если попросили."},
-                    {"role": "user", "content": prompt},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Анализируй это изображение."},
-                        {"type": "image_url", "image_url": {"url": photo_url}}
-                    ]}
-                ]
-            )
-            answer = response.choices[0].message.content
-            await message.reply(answer)
-            await save_message(user_id, 'assistant', answer)
-        else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
-                [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
-            ])
-            await message.reply("Лимит на анализ фото исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
-    except Exception as e:
-        print(f"Ошибка в handle_photo: {str(e)}")
-        await message.reply("Ошибка анализа фото: попробуй позже.")
+    if message.media_group_id:
+        collect_media_group(message)  # Альбом: ждём остальные фото и отвечаем одним сообщением
+        return
+    await analyze_photos([message])
 
 @dp.message(F.text == "Текст")
 async def text_mode(message: types.Message):
-    await message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Изображение")
 async def image_mode(message: types.Message):
-    await message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Анализ фото")
 async def vision_mode(message: types.Message):
-    await message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+    await send_reply(message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Код")
 async def code_mode(message: types.Message):
-    await message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Подписка")
 async def pay_mode(message: types.Message):
@@ -310,12 +1167,12 @@ async def pay_mode(message: types.Message):
         [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
         [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
     ])
-    await message.reply("Выбери тариф для подписки на AI:", reply_markup=keyboard)
+    await send_reply(message, "Выбери тариф для подписки на AI:", reply_markup=keyboard)
 
 @dp.message(F.text == "Новый чат")
 async def new_chat(message: types.Message):
     await clear_history(message.from_user.id)
-    await message.reply("Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Помощь")
 async def help_command(message: types.Message):
@@ -331,8 +1188,9 @@ async def help_command(message: types.Message):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
     """
-    await message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+    await send_reply(message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
 
 # Handler для inline кнопок из /start
 @dp.callback_query(lambda c: c.data in ['text', 'image', 'vision', 'code', 'pay', 'help'])
@@ -340,15 +1198,15 @@ async def inline_button_handler(callback: types.CallbackQuery):
     try:
         print(f"Inline кнопка нажата: {callback.data}")  # Лог для отладки
         if callback.data == 'text':
-            await callback.message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
         elif callback.data == 'image':
-            await callback.message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
         elif callback.data == 'vision':
-            await callback.message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
         elif callback.data == 'code':
-            await callback.message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
         elif callback.data == 'pay':
-            await callback.message.reply("Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            await send_reply(callback.message, "Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
                 [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
             ]))
@@ -365,8 +1223,9 @@ async def inline_button_handler(callback: types.CallbackQuery):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
             """
-            await callback.message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+            await send_reply(callback.message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
         await callback.answer()
     except Exception as e:
         print(f"Ошибка в inline_button_handler: {e}")
@@ -374,58 +1233,26 @@ async def inline_button_handler(callback: types.CallbackQuery):
 
 @dp.message(F.photo)  # Handler для фото
 async def handle_photo(message: types.Message):
-    try:
-        user_id = message.from_user.id
-        is_premium = await get_premium_status(user_id)
-        uses_vision_left = await get_vision_uses(user_id)
-        if is_premium or uses_vision_left > 0:
-            await decrement_vision_uses(user_id) if not is_premium else None
-            # Скачивание файла фото
-            file_id = message.photo[-1].file_id
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
-            photo_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_path}"
-            # GPT Vision анализ
-            prompt = message.caption or "Что на этом фото?"
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты полезный AI-аналитик изображений на русском языке. Опиши, что на фото, или сгенерируй подпись, если попросили."},
-                    {"role": "user", "content": prompt},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Анализируй это изображение."},
-                        {"type": "image_url", "image_url": {"url": photo_url}}
-                    ]}
-                ]
-            )
-            answer = response.choices[0].message.content
-            await message.reply(answer)
-            await save_message(user_id, 'assistant', answer)
-        else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
-                [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
-            ])
-            await message.reply("Лимит на анализ фото исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
-    except Exception as e:
-        print(f"Ошибка в handle_photo: {str(e)}")
-        await message.reply("Ошибка анализа фото: попробуй позже.")
+    if message.media_group_id:
+        collect_media_group(message)  # Альбом: ждём остальные фото и отвечаем одним сообщением
+        return
+    await analyze_photos([message])
 
 @dp.message(F.text == "Текст")
 async def text_mode(message: types.Message):
-    await message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Изображение")
 async def image_mode(message: types.Message):
-    await message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Анализ фото")
 async def vision_mode(message: types.Message):
-    await message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+    await send_reply(message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Код")
 async def code_mode(message: types.Message):
-    await message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Подписка")
 async def pay_mode(message: types.Message):
@@ -433,12 +1260,12 @@ async def pay_mode(message: types.Message):
         [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
         [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
     ])
-    await message.reply("Выбери тариф для подписки на AI:", reply_markup=keyboard)
+    await send_reply(message, "Выбери тариф для подписки на AI:", reply_markup=keyboard)
 
 @dp.message(F.text == "Новый чат")
 async def new_chat(message: types.Message):
     await clear_history(message.from_user.id)
-    await message.reply("Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Помощь")
 async def help_command(message: types.Message):
@@ -454,8 +1281,9 @@ async def help_command(message: types.Message):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
     """
-    await message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+    await send_reply(message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
 
 # Handler для inline кнопок из /start
 @dp.callback_query(lambda c: c.data in ['text', 'image', 'vision', 'code', 'pay', 'help'])
@@ -463,15 +1291,15 @@ async def inline_button_handler(callback: types.CallbackQuery):
     try:
         print(f"Inline кнопка нажата: {callback.data}")  # Лог для отладки
         if callback.data == 'text':
-            await callback.message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
         elif callback.data == 'image':
-            await callback.message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
         elif callback.data == 'vision':
-            await callback.message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
         elif callback.data == 'code':
-            await callback.message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
         elif callback.data == 'pay':
-            await callback.message.reply("Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            await send_reply(callback.message, "Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
                 [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
             ]))
@@ -488,8 +1316,9 @@ async def inline_button_handler(callback: types.CallbackQuery):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
             """
-            await callback.message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+            await send_reply(callback.message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
         await callback.answer()
     except Exception as e:
         print(f"Ошибка в inline_button_handler: {e}")
@@ -497,58 +1326,26 @@ async def inline_button_handler(callback: types.CallbackQuery):
 
 @dp.message(F.photo)  # Handler для фото
 async def handle_photo(message: types.Message):
-    try:
-        user_id = message.from_user.id
-        is_premium = await get_premium_status(user_id)
-        uses_vision_left = await get_vision_uses(user_id)
-        if is_premium or uses_vision_left > 0:
-            await decrement_vision_uses(user_id) if not is_premium else None
-            # Скачивание файла фото
-            file_id = message.photo[-1].file_id
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
-            photo_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_path}"
-            # GPT Vision анализ
-            prompt = message.caption or "Что на этом фото?"
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты полезный AI-аналитик изображений на русском языке. Опиши, что на фото, или сгенерируй подпись, если попросили."},
-                    {"role": "user", "content": prompt},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Анализируй это изображение."},
-                        {"type": "image_url", "image_url": {"url": photo_url}}
-                    ]}
-                ]
-            )
-            answer = response.choices[0].message.content
-            await message.reply(answer)
-            await save_message(user_id, 'assistant', answer)
-        else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
-                [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
-            ])
-            await message.reply("Лимит на анализ фото исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
-    except Exception as e:
-        print(f"Ошибка в handle_photo: {str(e)}")
-        await message.reply("Ошибка анализа фото: попробуй позже.")
+    if message.media_group_id:
+        collect_media_group(message)  # Альбом: ждём остальные фото и отвечаем одним сообщением
+        return
+    await analyze_photos([message])
 
 @dp.message(F.text == "Текст")
 async def text_mode(message: types.Message):
-    await message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Изображение")
 async def image_mode(message: types.Message):
-    await message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Анализ фото")
 async def vision_mode(message: types.Message):
-    await message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+    await send_reply(message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Код")
 async def code_mode(message: types.Message):
-    await message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Подписка")
 async def pay_mode(message: types.Message):
@@ -556,12 +1353,12 @@ async def pay_mode(message: types.Message):
         [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
         [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
     ])
-    await message.reply("Выбери тариф для подписки на AI:", reply_markup=keyboard)
+    await send_reply(message, "Выбери тариф для подписки на AI:", reply_markup=keyboard)
 
 @dp.message(F.text == "Новый чат")
 async def new_chat(message: types.Message):
     await clear_history(message.from_user.id)
-    await message.reply("Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Помощь")
 async def help_command(message: types.Message):
@@ -577,8 +1374,9 @@ async def help_command(message: types.Message):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
     """
-    await message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+    await send_reply(message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
 
 # Handler для inline кнопок из /start
 @dp.callback_query(lambda c: c.data in ['text', 'image', 'vision', 'code', 'pay', 'help'])
@@ -586,15 +1384,15 @@ async def inline_button_handler(callback: types.CallbackQuery):
     try:
         print(f"Inline кнопка нажата: {callback.data}")  # Лог для отладки
         if callback.data == 'text':
-            await callback.message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
         elif callback.data == 'image':
-            await callback.message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
         elif callback.data == 'vision':
-            await callback.message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
         elif callback.data == 'code':
-            await callback.message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
         elif callback.data == 'pay':
-            await callback.message.reply("Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            await send_reply(callback.message, "Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
                 [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
             ]))
@@ -611,8 +1409,9 @@ async def inline_button_handler(callback: types.CallbackQuery):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
             """
-            await callback.message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+            await send_reply(callback.message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
         await callback.answer()
     except Exception as e:
         print(f"Ошибка в inline_button_handler: {e}")
@@ -620,58 +1419,26 @@ async def inline_button_handler(callback: types.CallbackQuery):
 
 @dp.message(F.photo)  # Handler для фото
 async def handle_photo(message: types.Message):
-    try:
-        user_id = message.from_user.id
-        is_premium = await get_premium_status(user_id)
-        uses_vision_left = await get_vision_uses(user_id)
-        if is_premium or uses_vision_left > 0:
-            await decrement_vision_uses(user_id) if not is_premium else None
-            # Скачивание файла фото
-            file_id = message.photo[-1].file_id
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
-            photo_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_path}"
-            # GPT Vision анализ
-            prompt = message.caption or "Что на этом фото?"
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты полезный AI-аналитик изображений на русском языке. Опиши, что на фото, или сгенерируй подпись, если попросили."},
-                    {"role": "user", "content": prompt},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Анализируй это изображение."},
-                        {"type": "image_url", "image_url": {"url": photo_url}}
-                    ]}
-                ]
-            )
-            answer = response.choices[0].message.content
-            await message.reply(answer)
-            await save_message(user_id, 'assistant', answer)
-        else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
-                [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
-            ])
-            await message.reply("Лимит на анализ фото исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
-    except Exception as e:
-        print(f"Ошибка в handle_photo: {str(e)}")
-        await message.reply("Ошибка анализа фото: попробуй позже.")
+    if message.media_group_id:
+        collect_media_group(message)  # Альбом: ждём остальные фото и отвечаем одним сообщением
+        return
+    await analyze_photos([message])
 
 @dp.message(F.text == "Текст")
 async def text_mode(message: types.Message):
-    await message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Изображение")
 async def image_mode(message: types.Message):
-    await message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Анализ фото")
 async def vision_mode(message: types.Message):
-    await message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+    await send_reply(message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Код")
 async def code_mode(message: types.Message):
-    await message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Подписка")
 async def pay_mode(message: types.Message):
@@ -679,12 +1446,12 @@ async def pay_mode(message: types.Message):
         [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
         [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
     ])
-    await message.reply("Выбери тариф для подписки на AI:", reply_markup=keyboard)
+    await send_reply(message, "Выбери тариф для подписки на AI:", reply_markup=keyboard)
 
 @dp.message(F.text == "Новый чат")
 async def new_chat(message: types.Message):
     await clear_history(message.from_user.id)
-    await message.reply("Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Помощь")
 async def help_command(message: types.Message):
@@ -700,8 +1467,9 @@ async def help_command(message: types.Message):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
     """
-    await message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+    await send_reply(message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
 
 # Handler для inline кнопок из /start
 @dp.callback_query(lambda c: c.data in ['text', 'image', 'vision', 'code', 'pay', 'help'])
@@ -709,15 +1477,15 @@ async def inline_button_handler(callback: types.CallbackQuery):
     try:
         print(f"Inline кнопка нажата: {callback.data}")  # Лог для отладки
         if callback.data == 'text':
-            await callback.message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
         elif callback.data == 'image':
-            await callback.message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
         elif callback.data == 'vision':
-            await callback.message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
         elif callback.data == 'code':
-            await callback.message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+            await send_reply(callback.message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
         elif callback.data == 'pay':
-            await callback.message.reply("Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            await send_reply(callback.message, "Выбери тариф для подписки на AI:", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
                 [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
             ]))
@@ -734,8 +1502,9 @@ async def inline_button_handler(callback: types.CallbackQuery):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
             """
-            await callback.message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+            await send_reply(callback.message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
         await callback.answer()
     except Exception as e:
         print(f"Ошибка в inline_button_handler: {e}")
@@ -743,58 +1512,26 @@ async def inline_button_handler(callback: types.CallbackQuery):
 
 @dp.message(F.photo)  # Handler для фото
 async def handle_photo(message: types.Message):
-    try:
-        user_id = message.from_user.id
-        is_premium = await get_premium_status(user_id)
-        uses_vision_left = await get_vision_uses(user_id)
-        if is_premium or uses_vision_left > 0:
-            await decrement_vision_uses(user_id) if not is_premium else None
-            # Скачивание файла фото
-            file_id = message.photo[-1].file_id
-            file = await bot.get_file(file_id)
-            file_path = file.file_path
-            photo_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_path}"
-            # GPT Vision анализ
-            prompt = message.caption or "Что на этом фото?"
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Ты полезный AI-аналитик изображений на русском языке. Опиши, что на фото, или сгенерируй подпись, если попросили."},
-                    {"role": "user", "content": prompt},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Анализируй это изображение."},
-                        {"type": "image_url", "image_url": {"url": photo_url}}
-                    ]}
-                ]
-            )
-            answer = response.choices[0].message.content
-            await message.reply(answer)
-            await save_message(user_id, 'assistant', answer)
-        else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
-                [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
-            ])
-            await message.reply("Лимит на анализ фото исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
-    except Exception as e:
-        print(f"Ошибка в handle_photo: {str(e)}")
-        await message.reply("Ошибка анализа фото: попробуй позже.")
+    if message.media_group_id:
+        collect_media_group(message)  # Альбом: ждём остальные фото и отвечаем одним сообщением
+        return
+    await analyze_photos([message])
 
 @dp.message(F.text == "Текст")
 async def text_mode(message: types.Message):
-    await message.reply("Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Режим текста активен. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Изображение")
 async def image_mode(message: types.Message):
-    await message.reply("Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим изображения активен. Напиши 'Нарисуй [описание]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Анализ фото")
 async def vision_mode(message: types.Message):
-    await message.reply("Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
+    await send_reply(message, "Режим анализа фото активен. Пришли фото!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Код")
 async def code_mode(message: types.Message):
-    await message.reply("Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
+    await send_reply(message, "Режим генерации кода активен. Напиши 'Напиши код на Python для [задача]'!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Подписка")
 async def pay_mode(message: types.Message):
@@ -802,12 +1539,12 @@ async def pay_mode(message: types.Message):
         [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
         [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
     ])
-    await message.reply("Выбери тариф для подписки на AI:", reply_markup=keyboard)
+    await send_reply(message, "Выбери тариф для подписки на AI:", reply_markup=keyboard)
 
 @dp.message(F.text == "Новый чат")
 async def new_chat(message: types.Message):
     await clear_history(message.from_user.id)
-    await message.reply("Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
+    await send_reply(message, "Новый чат начат! История очищена. Задавай вопросы!", reply_markup=reply_kb)
 
 @dp.message(F.text == "Помощь")
 async def help_command(message: types.Message):
@@ -823,23 +1560,35 @@ async def help_command(message: types.Message):
 Бесплатно: 20 текст + 10 изображений + 3 анализа + 5 кода. /pay для подписки.
 
 История чата сохраняется (5 сообщений бесплатно, 10 в премиум).
+/merge — склеивать сообщения, отправленные подряд, в один запрос.
     """
-    await message.reply(help_text, parse_mode="Markdown", reply_markup=reply_kb)
+    await send_reply(message, help_text, parse_mode="Markdown", reply_markup=reply_kb)
 
 @dp.message()
 async def handle_message(message: types.Message):
+    if not message.text:
+        # Без текста в AI отправлять нечего — отвечаем подсказкой, не трогая БД
+        await send_reply(message, "Я понимаю текст и фото. Напиши вопрос или пришли фото!")
+        return
+    if await get_merge_messages(message.from_user.id):
+        collect_text_burst(message)  # Склейка: ждём, пока пользователь допишет
+        return
+    await process_text(message, message.text)
+
+# Обработка текстового запроса (одно сообщение или склеенная пачка)
+async def process_text(message, text):
     try:
-        await save_message(message.from_user.id, 'user', message.text)
+        turn_id = await save_message(message.from_user.id, 'user', text)
         user_id = message.from_user.id
         is_premium = await get_premium_status(user_id)
-        text_lower = message.text.lower()
-        if any(word in text_lower for word in ['нарисуй', 'draw', 'generate image', 'картинка', 'изображение', 'picture']):
+        mode = detect_mode(text)
+        if mode == 'image':
             uses_image_left = await get_image_uses(user_id)
             if is_premium or uses_image_left > 0:
                 await decrement_image_uses(user_id) if not is_premium else None
                 print("Начинаю генерацию изображения...")
                 # Генерация изображения с Pollinations.ai (бесплатно, GET)
-                prompt = message.text.replace(' ', '%20')  # URL-encode
+                prompt = text.replace(' ', '%20')  # URL-encode
                 seed = random.randint(1, 1000000)  # Случайный seed для вариаций
                 api_url = f"https://pollinations.ai/p/{prompt}?seed={seed}"
                 response = requests.get(api_url)
@@ -848,7 +1597,7 @@ async def handle_message(message: types.Message):
                     if len(image_bytes) > 1000:  # Проверка на реальное изображение
                         bytes_io = io.BytesIO(image_bytes)
                         photo = BufferedInputFile(bytes_io.getvalue(), filename="image.png")
-                        await message.reply_photo(photo=photo, caption="Вот твоё изображение! 🎨")
+                        await send_queued(message.chat.id, lambda: message.reply_photo(photo=photo, caption="Вот твоё изображение! 🎨"), premium=is_premium)
                         await save_message(user_id, 'assistant', 'Изображение сгенерировано.')
                     else:
                         raise Exception("Ответ не содержит изображение")
@@ -859,62 +1608,192 @@ async def handle_message(message: types.Message):
                     [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
                     [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
                 ])
-                await message.reply("Лимит на изображения исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
-        elif any(word in text_lower for word in ['код', 'напиши код', 'code', 'программа']):
+                await send_reply(message, "Лимит на изображения исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
+        elif mode == 'code':
             uses_code_left = await get_code_uses(user_id)
             if is_premium or uses_code_left > 0:
                 await decrement_code_uses(user_id) if not is_premium else None
                 # Генерация кода
-                history = await get_message_history(user_id, 5 if not is_premium else 10)
-                messages = [{'role': msg['role'], 'content': msg['content']} for msg in history]
-                messages.append({"role": "user", "content": message.text})
-                response = await client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "Ты ассистент по программированию. Генерируй код с объяснением на русском языке. Используй markdown для кода (```python ... ```)."},
-                        *messages
-                    ]
-                )
+                # Текущий вопрос идёт отдельным ходом в конце, поэтому берём историю до него
+                history = await get_message_history(user_id, 5 if not is_premium else 10, before_id=turn_id)
+                context = await retrieve_context(user_id, text, len(history) + 1)
+                response = await complete('code', user_id, is_premium, build_messages('code', history, text, context))
                 answer = response.choices[0].message.content
-                await message.reply(answer)
+                await send_reply(message, answer, premium=is_premium)
                 await save_message(user_id, 'assistant', answer)
             else:
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
                     [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
                 ])
-                await message.reply("Лимит на генерацию кода исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
+                await send_reply(message, "Лимит на генерацию кода исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
         else:
             uses_text_left = await get_text_uses(user_id)
             if is_premium or uses_text_left > 0:
                 await decrement_text_uses(user_id) if not is_premium else None
                 # Текст с историей
-                history = await get_message_history(user_id, 5 if not is_premium else 10)
-                messages = [{'role': msg['role'], 'content': msg['content']} for msg in history]
-                messages.append({"role": "user", "content": message.text})
-                response = await client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=messages
-                )
+                # Текущий вопрос идёт отдельным ходом в конце, поэтому берём историю до него
+                history = await get_message_history(user_id, 5 if not is_premium else 10, before_id=turn_id)
+                context = await retrieve_context(user_id, text, len(history) + 1)
+                response = await complete('text', user_id, is_premium, build_messages('text', history, text, context))
                 answer = response.choices[0].message.content
-                await message.reply(answer)
+                await send_reply(message, answer, premium=is_premium)
                 await save_message(user_id, 'assistant', answer)
             else:
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="🛒 Стандарт: 200 руб/месяц", callback_data="pay_standard")],
                     [InlineKeyboardButton(text="⭐ Премиум: 500 руб/3 месяца", callback_data="pay_premium")]
                 ])
-                await message.reply("Лимит на текст исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
+                await send_reply(message, "Лимит на текст исчерпан! Подпишись за 200 руб:", reply_markup=keyboard)
     except Exception as e:
         print(f"Ошибка в handle_message: {str(e)}")
-        await message.reply("Ошибка AI: попробуй позже.")
+        await send_reply(message, "Ошибка AI: попробуй позже.")
+
+# Склейка быстрых сообщений подряд в один запрос
+text_bursts = {}  # user_id -> {'messages': [...], 'chars': int, 'started': monotonic, 'task': asyncio.Task}
+debounce_stats = {'calls': 0, 'messages': 0}
+
+def collect_text_burst(message):
+    user_id = message.from_user.id
+    burst = text_bursts.setdefault(user_id, {'messages': [], 'chars': 0, 'started': time.monotonic(), 'task': None})
+    burst['messages'].append(message)
+    burst['chars'] += len(message.text)
+    if burst['task']:
+        burst['task'].cancel()
+    if len(burst['messages']) >= DEBOUNCE_MAX_MESSAGES or burst['chars'] >= DEBOUNCE_MAX_CHARS:
+        # Пачка заполнена — отправляем сразу; следующее сообщение откроет новую пачку и снова заплатит в rate limit
+        del text_bursts[user_id]
+        asyncio.create_task(process_text_burst(user_id, burst['messages']))
+        return
+    # Окно сдвигается с каждым сообщением, но не дальше DEBOUNCE_MAX_WAIT от первого
+    delay = max(0, min(DEBOUNCE_WINDOW, burst['started'] + DEBOUNCE_MAX_WAIT - time.monotonic()))
+    burst['task'] = asyncio.create_task(flush_text_burst(user_id, delay))
+
+async def flush_text_burst(user_id, delay):
+    await asyncio.sleep(delay)
+    await process_text_burst(user_id, text_bursts.pop(user_id)['messages'])
+
+async def process_text_burst(user_id, messages):
+    debounce_stats['calls'] += 1
+    debounce_stats['messages'] += len(messages)
+    print(f"Debounce: user={user_id} merged={len(messages)} avg_per_call={debounce_stats['messages'] / debounce_stats['calls']:.2f} calls_saved={debounce_stats['messages'] - debounce_stats['calls']}")
+    with track_inflight():
+        await process_text(messages[-1], "\n".join(m.text for m in messages))
+
+# Остановка и перезапуск без потерь
+inflight_tasks = set()
+shutting_down = False
+
+@contextlib.contextmanager
+def track_inflight():
+    task = asyncio.current_task()
+    inflight_tasks.add(task)
+    try:
+        yield
+    finally:
+        inflight_tasks.discard(task)
+
+def spool_updates(updates):
+    with open(SPOOL_PATH, 'a', encoding='utf-8') as f:
+        for update in updates:
+            f.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+def message_update(message):
+    return {'update_id': 0, 'message': json.loads(message.model_dump_json(by_alias=True, exclude_none=True))}
+
+@dp.update.outer_middleware()
+async def inflight_middleware(handler, update, data):
+    if shutting_down:
+        # Апдейт пришёл во время остановки — обработаем после перезапуска
+        spool_updates([json.loads(update.model_dump_json(by_alias=True, exclude_none=True))])
+        return None
+    with track_inflight():
+        return await handler(update, data)
+
+@dp.shutdown()
+async def on_shutdown():
+    global shutting_down
+    shutting_down = True
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    # Альбомы и пачки, которые ещё ждут своего окна, не обрабатываем, а сохраняем как есть
+    buffered = []
+    for buffers in (media_groups, text_bursts):
+        for buffer in buffers.values():
+            buffer['task'].cancel()
+            buffered.extend(message_update(m) for m in buffer['messages'])
+        buffers.clear()
+    if buffered:
+        spool_updates(buffered)
+    pending = inflight_tasks - {asyncio.current_task()}
+    if pending:
+        print(f"Остановка: жду {len(pending)} обработчиков")
+        _, pending = await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+        if pending:
+            print(f"Остановка: {len(pending)} обработчиков не успели завершиться")
+    try:
+        await asyncio.wait_for(outbound_queue.join(), timeout=max(0.1, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        print(f"Остановка: не отправлено сообщений: {(outbound_queue.qsize() + len(outbound_delayed))}")
+    try:
+        await flush_usage()
+    except Exception as e:
+        print(f"Ошибка сброса статистики: {e}")
+    # Соединения с SQLite открываются на каждый запрос, держать открытыми нечего; сессию бота закрывает aiogram
+    await client.close()
+    print(f"Остановка завершена, сохранено апдейтов: {len(buffered)}")
+
+def read_spool(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_spool(path, updates):
+    # Через временный файл: при падении посреди записи на диске остаётся прежняя версия
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for update in updates:
+            f.write(json.dumps(update, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+async def replay_spool():
+    # Новые апдейты сначала переносим в .replay, чтобы спул, дописанный при следующей остановке, не смешался с повтором.
+    # Остаток .replay после падения посреди повтора обрабатываем первым
+    replay_path = SPOOL_PATH + '.replay'
+    updates = read_spool(replay_path) + read_spool(SPOOL_PATH)
+    if not updates:
+        return
+    write_spool(replay_path, updates)
+    if os.path.exists(SPOOL_PATH):
+        os.remove(SPOOL_PATH)
+    print(f"Повтор необработанных апдейтов: {len(updates)}")
+    # По порядку: первое сообщение пачки/альбома должно открыть буфер раньше остальных,
+    # иначе каждое из них заново пройдёт лимит частоты. Сами AI-запросы идут в фоновых задачах склейки
+    for i, update in enumerate(updates):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            print(f"Ошибка повтора апдейта: {e}")
+        # Файл укорачиваем только после обработки: после падения заново пройдёт не больше одного апдейта
+        write_spool(replay_path, updates[i + 1:])
+    os.remove(replay_path)
 
 async def main():
     await init_db()  # Инициализация БД при старте
+    await load_subscriptions()
+    await load_merge_settings()
+    background_tasks = [asyncio.create_task(outbound_worker()) for _ in range(OUTBOUND_WORKERS)]
+    background_tasks.append(asyncio.create_task(outbound_delay_pump()))
+    background_tasks.append(asyncio.create_task(subscription_scheduler()))
+    background_tasks.append(asyncio.create_task(usage_flusher()))
     try:
-        await dp.start_polling(bot)
+        await replay_spool()  # До polling: старые апдейты обрабатываются раньше новых
+        await dp.start_polling(bot)  # По SIGINT/SIGTERM aiogram прекращает получать апдейты и вызывает on_shutdown
     except Exception as e:
         print(f"Ошибка polling: {e}")
+    finally:
+        for task in background_tasks:
+            task.cancel()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file